@@ -0,0 +1,222 @@
+"""
+A module to read gzip and BGZF compressed FASTA files without first writing
+an uncompressed copy to disk. BGZF files are decompressed block-parallel.
+Written by: David Straat
+"""
+
+import gzip
+import io
+import os
+import shutil
+import struct
+import subprocess
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+GZIP_MAGIC = b'\x1f\x8b'
+CHUNK_SIZE = 1 << 20
+
+
+def isCompressed(file_path):
+    """
+    Check whether a file is gzip compressed (this includes BGZF).
+    :param file_path: The path of the file to check.
+    :return: True if the file starts with the gzip magic bytes.
+    """
+    with open(file_path, 'rb') as handle:
+        return handle.read(2) == GZIP_MAGIC
+
+
+def isBgzf(file_path):
+    """
+    Check whether a file is BGZF compressed, i.e. a series of gzip members
+    that each carry their own compressed size in a 'BC' extra field.
+    :param file_path: The path of the file to check.
+    :return: True if the first block of the file is a BGZF block.
+    """
+    with open(file_path, 'rb') as handle:
+        header = handle.read(12)
+        if len(header) < 12 or header[:2] != GZIP_MAGIC \
+                or not header[3] & 4:
+            return False
+        extra = handle.read(struct.unpack('<H', header[10:12])[0])
+    return _blockSize(extra) is not None
+
+
+def _blockSize(extra):
+    """
+    Get the BSIZE value from the extra field of a gzip header.
+    :param extra: The bytes of the extra field.
+    :return: The total block size minus one, or None if there is no 'BC'
+    subfield.
+    """
+    offset = 0
+    while offset + 4 <= len(extra):
+        subfield_length = struct.unpack('<H', extra[offset + 2:offset + 4])[0]
+        if extra[offset:offset + 2] == b'BC' and subfield_length == 2:
+            return struct.unpack('<H', extra[offset + 4:offset + 6])[0]
+        offset += 4 + subfield_length
+    return None
+
+
+def _readBgzfBlocks(handle):
+    """
+    Read the raw deflate data of the BGZF blocks in a file.
+    :param handle: A binary file handle positioned at the start of a block.
+    :return: A generator of (compressed data, crc32, uncompressed size)
+    tuples, one per block.
+    """
+    while True:
+        header = handle.read(12)
+        if not header:
+            return
+        if len(header) < 12 or header[:2] != GZIP_MAGIC:
+            raise gzip.BadGzipFile('Invalid BGZF block header.')
+        extra_length = struct.unpack('<H', header[10:12])[0]
+        extra = handle.read(extra_length)
+        block_size = _blockSize(extra)
+        if block_size is None:
+            raise gzip.BadGzipFile('BGZF block is missing its BC field.')
+        remainder = handle.read(block_size + 1 - 12 - extra_length)
+        crc, size = struct.unpack('<II', remainder[-8:])
+        yield remainder[:-8], crc, size
+
+
+def _inflateBlock(block):
+    """
+    Decompress a single BGZF block and verify its checksum.
+    :param block: A (compressed data, crc32, uncompressed size) tuple.
+    :return: The uncompressed bytes of the block.
+    """
+    data, crc, size = block
+    inflated = zlib.decompress(data, -zlib.MAX_WBITS)
+    if len(inflated) != size or zlib.crc32(inflated) != crc:
+        raise gzip.BadGzipFile('BGZF block failed its integrity check.')
+    return inflated
+
+
+def iterDecompressed(file_path, threads=None):
+    """
+    Read a file as a stream of uncompressed byte chunks. BGZF files are
+    inflated on a thread pool (zlib releases the GIL), plain gzip files are
+    streamed and uncompressed files are read as they are.
+    :param file_path: The path of the file to read.
+    :param threads: The number of threads used for BGZF files. Defaults to
+    the number of CPUs.
+    :return: A generator of byte chunks, in file order.
+    """
+    if not isCompressed(file_path):
+        with open(file_path, 'rb') as handle:
+            yield from iter(lambda: handle.read(CHUNK_SIZE), b'')
+        return
+    if not isBgzf(file_path):
+        with gzip.open(file_path, 'rb') as handle:
+            yield from iter(lambda: handle.read(CHUNK_SIZE), b'')
+        return
+    threads = threads or os.cpu_count() or 1
+    with open(file_path, 'rb') as handle, \
+            ThreadPoolExecutor(max_workers=threads) as pool:
+        # Keep a bounded number of blocks in flight so memory use does not
+        # grow with the size of the file.
+        pending = deque()
+        for block in _readBgzfBlocks(handle):
+            pending.append(pool.submit(_inflateBlock, block))
+            if len(pending) >= threads * 4:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+
+
+class _ChunkReader(io.RawIOBase):
+    """
+    A read-only binary stream over a generator of byte chunks.
+    """
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+        self.buffer = b''
+
+    def readable(self):
+        return True
+
+    def readinto(self, target):
+        while not self.buffer:
+            try:
+                self.buffer = next(self.chunks)
+            except StopIteration:
+                return 0
+        size = min(len(target), len(self.buffer))
+        target[:size] = self.buffer[:size]
+        self.buffer = self.buffer[size:]
+        return size
+
+    def close(self):
+        self.chunks.close()
+        super().close()
+
+
+def openBinary(file_path, threads=None):
+    """
+    Open a possibly compressed file as a binary stream that is decompressed
+    while it is being read.
+    :param file_path: The path of the file to open.
+    :param threads: The number of threads used for BGZF files. Defaults to
+    the number of CPUs.
+    :return: A binary file handle.
+    """
+    if not isCompressed(file_path):
+        return open(file_path, 'rb')
+    if not isBgzf(file_path):
+        return gzip.open(file_path, 'rb')
+    raw = _ChunkReader(iterDecompressed(file_path, threads=threads))
+    return io.BufferedReader(raw, CHUNK_SIZE)
+
+
+def openText(file_path, threads=None):
+    """
+    Open a possibly compressed file as a text stream that is decompressed
+    while it is being read.
+    :param file_path: The path of the file to open.
+    :param threads: The number of threads used for BGZF files. Defaults to
+    the number of CPUs.
+    :return: A text file handle.
+    """
+    return io.TextIOWrapper(openBinary(file_path, threads=threads))
+
+
+def pipeToCommand(command, file_path, output_file=None, threads=None):
+    """
+    Run an external command with the decompressed contents of a file on its
+    standard input, so no uncompressed copy is written to disk.
+    :param command: The command to run as a list of arguments. The command
+    should read its input from stdin, usually by passing '-' as file name.
+    :param file_path: The path of the file to feed to the command.
+    :param output_file: The file to write the standard output of the command
+    to. Defaults to None, in which case the output is not redirected.
+    :param threads: The number of threads used for BGZF files.
+    :return: The return code of the command.
+    """
+    if shutil.which(command[0]) is None:
+        raise FileNotFoundError(f'{command[0]} was not found on the PATH.')
+    stdout = open(output_file, 'wb') if output_file is not None else None
+    try:
+        process = subprocess.Popen(command, stdin=subprocess.PIPE,
+                                   stdout=stdout)
+        try:
+            for chunk in iterDecompressed(file_path, threads=threads):
+                process.stdin.write(chunk)
+            process.stdin.close()
+        except BrokenPipeError:
+            # The command stopped reading early, its return code tells why.
+            pass
+        except BaseException:
+            # The input could not be read, so the command gets no complete
+            # input and must not be left running or as a zombie.
+            process.kill()
+            process.wait()
+            raise
+        return process.wait()
+    finally:
+        if stdout is not None:
+            stdout.close()
@@ -12,21 +12,44 @@ class Conservation:
     conservation of a protein sequence and plot it.
     """
 
-    def __init__(self, file_path, ref=0):
+    def __init__(self, file_path, ref=0, verbose=True):
         self.file_path = file_path
-        self.canal = pycanal.Canal(self.file_path, ref=ref)
+        self.canal = pycanal.Canal(self.file_path, ref=ref, verbose=verbose)
 
-    def getConservation(self):
+    def getConservation(self, approximate=False, tolerance=0.01,
+                        time_budget=None, clusters=None):
         """
         Get the conservation of the protein sequence.
+        :param approximate: If True, the conservation is estimated from a
+        sample of the sequences. Defaults to False.
+        :param tolerance: The largest accepted error of an estimated site,
+        as a fraction of the largest score. Defaults to 0.01.
+        :param time_budget: The number of seconds after which sampling
+        stops. Defaults to None, meaning no time limit.
+        :param clusters: The cluster label of every sequence, to sample the
+        clusters in proportion to their size. Defaults to None.
         :return: A pandas dataframe with the conservation of each position.
         """
         try:
-            analysis = self.canal.analysis()
+            analysis = self.canal.analysis(approximate=approximate,
+                                           tolerance=tolerance,
+                                           time_budget=time_budget,
+                                           clusters=clusters)
             return analysis.rename(columns={"relative": "Relative Entropy"})
         except FileNotFoundError:
             print("The file was not found. Please run the pipeline first.")
 
+    def getConservationErrors(self):
+        """
+        Get the estimated errors of the last approximate conservation.
+        :return: A pandas dataframe with the standard error of each position,
+        or None if the conservation has not been estimated.
+        """
+        if self.canal.cons_errors is None:
+            return None
+        return self.canal.cons_errors.rename(
+            columns={"relative": "Relative Entropy"})
+
     def getConservationPlot(self, file_name=None, show=False, name=None,
                             graphType='line'):
         """
@@ -0,0 +1,251 @@
+"""
+A module to score the conservation of many family alignments at once and
+store the per-site results in a partitioned, memory-mapped column store.
+Written by: David Straat
+"""
+
+import json
+import os
+import shutil
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from conservation import Conservation
+from hydrophobicity import Hydrophobicity
+from regions import detectRegions
+
+METHODS = ['shannon', 'relative', 'lockless']
+COLUMNS = ['position', 'residue'] + METHODS + ['hydrophobicity']
+FASTA_SUFFIXES = ('.fasta', '.fas', '.fa', '.fna', '.faa', '.aln', '.msa')
+COMPRESSED_SUFFIXES = ('.gz', '.bgz')
+
+
+def familyName(file_path):
+    """
+    Get the family name of an alignment file, which is its file name without
+    the fasta and compression extensions.
+    :param file_path: The path of the alignment file.
+    :return: The family name.
+    """
+    name = os.path.basename(file_path)
+    for suffixes in (COMPRESSED_SUFFIXES, FASTA_SUFFIXES):
+        for suffix in suffixes:
+            if name.lower().endswith(suffix):
+                name = name[:-len(suffix)]
+                break
+    return name
+
+
+def analyzeFamily(file_path, ref=0):
+    """
+    Score every site of the reference sequence of one alignment. This is a
+    module level function so it can be sent to worker processes.
+    :param file_path: The path of the alignment file.
+    :param ref: The index of the reference sequence in the alignment.
+    :return: A tuple of the family name, the reference header and a dict of
+    numpy arrays, one per column in COLUMNS.
+    """
+    cons = Conservation(file_path, ref=ref, verbose=False)
+    scores = cons.canal.analysis(method='all')
+    # The residues of the reference at the scored sites, so every column has
+    # one value per site
+    residues = np.char.upper(
+        cons.canal.alignment[cons.canal.ref].view('S1').astype('U1'))
+    scale = Hydrophobicity('').aminozuur_dict
+    columns = {
+        'position': scores.index.values.astype(np.int32),
+        'residue': residues,
+        'hydrophobicity': np.array(
+            [scale.get(aa, np.nan) for aa in residues], dtype=np.float64)
+    }
+    for method in METHODS:
+        columns[method] = scores[method].values.astype(np.float64)
+    return familyName(file_path), cons.canal.reference_header, columns
+
+
+class ConservationStore:
+    """
+    A directory of per-family partitions holding the per-site conservation
+    scores and hydrophobicity of many alignments. Every column is stored as
+    a separate .npy file so queries can memory-map only what they need.
+    """
+
+    def __init__(self, path):
+        """
+        Opens or creates the store.
+        :param path: The directory of the store.
+        """
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def _partition(self, family):
+        """
+        Get the directory of a family partition.
+        :param family: The name of the family.
+        :return: The path of the partition.
+        """
+        return os.path.join(self.path, f'family={family}')
+
+    def families(self):
+        """
+        Get the families in the store.
+        :return: A sorted list of family names.
+        """
+        return sorted(entry[len('family='):] for entry in os.listdir(self.path)
+                      if entry.startswith('family=')
+                      and os.path.isfile(os.path.join(self.path, entry,
+                                                      'meta.json')))
+
+    def metadata(self, family):
+        """
+        Get the metadata of a family partition.
+        :param family: The name of the family.
+        :return: A dict with the reference, the number of sites and the
+        minimum and maximum score of each method.
+        """
+        with open(os.path.join(self._partition(family), 'meta.json')) as meta:
+            return json.load(meta)
+
+    def write(self, family, reference, columns):
+        """
+        Write the results of one family, replacing an earlier partition of
+        the same family.
+        :param family: The name of the family.
+        :param reference: The header of the reference sequence.
+        :param columns: A dict of equally long numpy arrays, one per column
+        in COLUMNS.
+        """
+        lengths = {column: len(columns[column]) for column in COLUMNS}
+        if len(set(lengths.values())) != 1:
+            raise ValueError(f'The columns of family {family} differ in '
+                             f'length: {lengths}.')
+        partition = self._partition(family)
+        temporary = f'{partition}.tmp'
+        shutil.rmtree(temporary, ignore_errors=True)
+        os.makedirs(temporary)
+        for column in COLUMNS:
+            np.save(os.path.join(temporary, f'{column}.npy'), columns[column])
+        meta = {'family': family, 'reference': reference,
+                'sites': int(len(columns['position']))}
+        for method in METHODS:
+            values = columns[method]
+            finite = values[np.isfinite(values)]
+            meta[method] = [float(finite.min()), float(finite.max())] \
+                if len(finite) else [None, None]
+        with open(os.path.join(temporary, 'meta.json'), 'w') as handle:
+            json.dump(meta, handle)
+        shutil.rmtree(partition, ignore_errors=True)
+        os.replace(temporary, partition)
+
+    def analyzeDirectory(self, directory, ref=0, processes=None):
+        """
+        Score all alignments in a directory over a process pool and append
+        the results to the store. An alignment that cannot be scored does
+        not stop the others, it is returned with its error instead.
+        :param directory: The directory containing the alignment files.
+        :param ref: The index of the reference sequence in each alignment.
+        :param processes: The number of worker processes. Defaults to the
+        number of CPUs.
+        :return: A list of the families that were written and a dict of the
+        files that failed with their exception.
+        """
+        files = sorted(
+            os.path.join(directory, name) for name in os.listdir(directory)
+            if familyName(name) != name)
+        written, failed = [], {}
+        with ProcessPoolExecutor(max_workers=processes) as pool:
+            futures = {file_path: pool.submit(analyzeFamily, file_path, ref)
+                       for file_path in files}
+            # Workers only compute, the results are written here so there is
+            # a single writer to the store.
+            for file_path, future in futures.items():
+                error = future.exception()
+                if error is not None:
+                    failed[file_path] = error
+                    continue
+                family, reference, columns = future.result()
+                self.write(family, reference, columns)
+                written.append(family)
+        return written, failed
+
+    def query(self, family=None, method='relative', threshold=None):
+        """
+        Load the per-site results of the store. Partitions are memory-mapped,
+        so only the rows passing the filters are read into memory, and
+        partitions whose maximum score is below the threshold are skipped.
+        :param family: A family name or a list of family names to load.
+        Defaults to None, meaning all families.
+        :param method: The method the threshold applies to. Defaults to
+        'relative'.
+        :param threshold: The minimum score of the sites to load. Defaults
+        to None, meaning all sites.
+        :return: A pandas dataframe with the family, reference, position,
+        residue, scores and hydrophobicity of each site.
+        """
+        if method not in METHODS:
+            raise ValueError(f'method must be one of {METHODS}.')
+        if family is None:
+            families = self.families()
+        elif isinstance(family, str):
+            families = [family]
+        else:
+            families = list(family)
+        frames = []
+        for name in families:
+            meta = self.metadata(name)
+            maximum = meta[method][1]
+            if threshold is not None and (maximum is None
+                                          or maximum < threshold):
+                continue
+            partition = self._partition(name)
+            data = {column: np.load(os.path.join(partition, f'{column}.npy'),
+                                    mmap_mode='r')
+                    for column in COLUMNS}
+            if threshold is None:
+                rows = slice(None)
+            else:
+                rows = np.flatnonzero(data[method] >= threshold)
+            frame = pd.DataFrame({column: np.asarray(data[column][rows])
+                                  for column in COLUMNS})
+            frame.insert(0, 'reference', meta['reference'])
+            frame.insert(0, 'family', name)
+            frames.append(frame)
+        if not frames:
+            return pd.DataFrame(columns=['family', 'reference'] + COLUMNS)
+        return pd.concat(frames, ignore_index=True)
+
+    def findRegions(self, family=None, method='relative', window=19,
+                    conservation_threshold=None,
+                    hydrophobicity_threshold=1.6):
+        """
+        Find the regions of the references in the store where the sliding
+        window means of the conservation and hydrophobicity exceed the
+        thresholds. All families are screened at once, see detectRegions.
+        :param family: A family name or a list of family names to screen.
+        Defaults to None, meaning all families.
+        :param method: The conservation method to use. Defaults to
+        'relative'.
+        :param window: The number of sites in a window. Defaults to 19.
+        :param conservation_threshold: The minimum window mean of the
+        conservation. Defaults to None, meaning it is not used.
+        :param hydrophobicity_threshold: The minimum window mean of the
+        hydrophobicity. Defaults to 1.6.
+        :return: A pandas dataframe with one row per region, with the family
+        and reference it was found in.
+        """
+        sites = self.query(family=family, method=method)
+        families, conservation, hydrophobicity, references = [], [], [], {}
+        for name, group in sites.groupby('family', sort=False):
+            families.append(name)
+            conservation.append(group[method].values)
+            hydrophobicity.append(group['hydrophobicity'].values)
+            references[name] = group['reference'].iloc[0]
+        regions = detectRegions(
+            families, conservation, hydrophobicity, window=window,
+            conservation_threshold=conservation_threshold,
+            hydrophobicity_threshold=hydrophobicity_threshold)
+        regions.insert(0, 'family', regions['reference'])
+        regions['reference'] = regions['family'].map(references)
+        return regions
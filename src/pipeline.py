@@ -5,12 +5,29 @@ Date: 25-sept-2023
 """
 import argparse
 import os
+import subprocess
+import time
 
 import numpy as np
 from Bio import SeqIO
 
+from compression import isCompressed, openText, pipeToCommand
 from conservation import Conservation
+from src import pycanal
 from hydrophobicity import Hydrophobicity
+from regions import detectRegions
+
+# MAFFT options of each alignment strategy, from most to least accurate
+MAFFT_STRATEGIES = {
+    'linsi': ['--localpair', '--maxiterate', '1000'],
+    'fftns2': ['--retree', '2', '--maxiterate', '0'],
+    'dpparttree': ['--retree', '1', '--dpparttree'],
+    'parttree': ['--retree', '1', '--parttree'],
+}
+LINSI_MAX_SEQUENCES = 200
+LINSI_MAX_LENGTH = 2000
+FFTNS2_MAX_SEQUENCES = 10000
+DPPARTTREE_MAX_SEQUENCES = 50000
 
 
 class Pipeline:
@@ -18,12 +35,23 @@ class Pipeline:
     A pipeline for building and searching HMMs.
     """
 
-    def __init__(self, file, nr_database, iterations=1):
+    def __init__(self, file, nr_database, iterations=1, align_strategy=None,
+                 threads=None, search_client=None):
         """
         Initiates the pipeline.
-        :param file: The file containing a MSAx to run the pipeline on.
-        :param nr_database: The nr database to use.
+        :param file: The file containing a MSAx to run the pipeline on. May
+        be gzip or BGZF compressed.
+        :param nr_database: The nr database to use. May be gzip or BGZF
+        compressed.
         :param iterations: The number of iterations to run.
+        :param align_strategy: The MAFFT strategy to align with, one of
+        MAFFT_STRATEGIES. Defaults to None, meaning it is chosen from the
+        size of the input.
+        :param threads: The number of threads MAFFT uses. Defaults to None,
+        meaning the number of CPUs.
+        :param search_client: A searchworker.SearchClient to search the
+        database with, which keeps the parsed database in memory instead of
+        reading it for every search. Defaults to None.
         """
         self.headers = None
         self.frame = None
@@ -37,23 +65,84 @@ class Pipeline:
         self.nrDatabase = nr_database
         self.iter = iterations
         self.msa_file = f'{self.file}-msa.fna'
+        self.align_strategy = align_strategy
+        self.threads = threads
+        self.align_log = []
+        self.search_client = search_client
 
     def readFasta(self):
         """
-        Reads the fasta file and stores the sequences and headers.
+        Reads the fasta file and stores the sequences and headers. Compressed
+        files are parsed while they are being decompressed.
         """
         self.sequences = []
         self.headers = []
-        self.sequences.extend(record.seq for record in SeqIO.parse(
-            self.file, "fasta"))
-        self.headers.extend(record.id for record in SeqIO.parse(
-            self.file, "fasta"))
+        with openText(self.file) as handle:
+            for record in SeqIO.parse(handle, "fasta"):
+                self.sequences.append(record.seq)
+                self.headers.append(record.id)
+
+    def chooseAlignStrategy(self):
+        """
+        Chooses a MAFFT strategy from the number and length of the sequences:
+        L-INS-i for small sets of short sequences, FFT-NS-2 for medium sets
+        and the PartTree methods for large sets.
+        :return: A tuple of the strategy name, the number of sequences and
+        the length of the longest sequence.
+        """
+        if self.sequences is None:
+            self.readFasta()
+        count = len(self.sequences)
+        max_length = max((len(str(seq).replace('-', ''))
+                          for seq in self.sequences), default=0)
+        if count <= LINSI_MAX_SEQUENCES and max_length <= LINSI_MAX_LENGTH:
+            strategy = 'linsi'
+        elif count <= FFTNS2_MAX_SEQUENCES:
+            strategy = 'fftns2'
+        elif count <= DPPARTTREE_MAX_SEQUENCES:
+            strategy = 'dpparttree'
+        else:
+            strategy = 'parttree'
+        return strategy, count, max_length
 
-    def align(self):
+    def align(self, strategy: str = None, threads: int = None):
         """
-        Aligns the sequences in the file using MAFFT.
+        Aligns the sequences in the file using MAFFT. Compressed files are
+        decompressed straight into MAFFT's standard input. The strategy,
+        input size, run time and return code are appended to align_log, and
+        a CalledProcessError is raised if MAFFT fails.
+        :param strategy: The MAFFT strategy to use, one of MAFFT_STRATEGIES.
+        Defaults to the strategy passed when initiating the class, or one
+        chosen from the size of the input.
+        :param threads: The number of threads MAFFT uses. Defaults to the
+        number passed when initiating the class, or the number of CPUs.
         """
-        os.system(f'mafft {self.file} > {self.msa_file}')
+        chosen, count, max_length = self.chooseAlignStrategy()
+        strategy = strategy or self.align_strategy or chosen
+        if strategy not in MAFFT_STRATEGIES:
+            raise ValueError(f'Unknown MAFFT strategy {strategy}, choose one '
+                             f'of {list(MAFFT_STRATEGIES)}.')
+        threads = threads or self.threads or os.cpu_count() or 1
+        options = MAFFT_STRATEGIES[strategy] + ['--thread', str(threads)]
+        start = time.perf_counter()
+        if isCompressed(self.file):
+            command = ['mafft'] + options + ['-']
+            returncode = pipeToCommand(command, self.file, self.msa_file)
+        else:
+            command = f'mafft {" ".join(options)} {self.file} > ' \
+                      f'{self.msa_file}'
+            returncode = os.waitstatus_to_exitcode(os.system(command))
+        self.align_log.append({
+            'strategy': strategy,
+            'chosen': strategy == chosen,
+            'sequences': count,
+            'max_length': max_length,
+            'threads': threads,
+            'seconds': time.perf_counter() - start,
+            'returncode': returncode
+        })
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command)
 
     def hmmBuild(self):
         """
@@ -63,10 +152,24 @@ class Pipeline:
 
     def hmmSearch(self):
         """
-        Searches the database for sequences that match the HMM.
+        Searches the database for sequences that match the HMM. If the
+        pipeline has a search client, its worker is used, which keeps the
+        parsed database in memory. Otherwise a compressed database is
+        decompressed straight into hmmsearch's standard input, and a
+        CalledProcessError is raised if hmmsearch fails.
         """
-        os.system(f'hmmsearch --tblout {self.file}-output.txt '
-                  f'{self.file}.hmm {self.nrDatabase}')
+        if self.search_client is not None:
+            self.search_client.search(f'{self.file}.hmm',
+                                      f'{self.file}-output.txt')
+        elif isCompressed(self.nrDatabase):
+            command = ['hmmsearch', '--tblout', f'{self.file}-output.txt',
+                       f'{self.file}.hmm', '-']
+            returncode = pipeToCommand(command, self.nrDatabase)
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, command)
+        else:
+            os.system(f'hmmsearch --tblout {self.file}-output.txt '
+                      f'{self.file}.hmm {self.nrDatabase}')
 
     def run(self, iterations: int = None, get_plot: bool = False):
         """
@@ -134,6 +237,49 @@ class Pipeline:
                                             10))
         self.plot = self.plot.get_figure()
 
+    def getRegions(self, ref_seqs: list = None, window: int = 19,
+                   conservation_threshold: float = None,
+                   hydrophobicity_threshold: float = 1.6):
+        """
+        Finds the regions of the reference sequences where the sliding
+        window means of the conservation and hydrophobicity exceed the
+        thresholds, such as conserved hydrophobic patches and candidate
+        transmembrane segments. The alignment is parsed and counted once
+        for all references, and all references are screened at once.
+        :param ref_seqs: The reference sequence IDs to screen. Defaults to
+        all sequences.
+        :param window: The number of sites in a window. Defaults to 19.
+        :param conservation_threshold: The minimum window mean of the
+        relative entropy. Defaults to None, meaning it is not used.
+        :param hydrophobicity_threshold: The minimum window mean of the
+        hydrophobicity. Defaults to 1.6.
+        :return: A pandas dataframe with one row per region.
+        """
+        if self.sequences is None:
+            self.readFasta()
+        if ref_seqs is None:
+            ref_seqs = range(len(self.sequences))
+        ref_seqs = list(ref_seqs)
+        sequences = [str(seq) for seq in self.sequences]
+        assert len({len(seq) for seq in sequences}) == 1, \
+            f'The sequences in {self.file} must be aligned.'
+        alignment = pycanal.alignmentBytes(sequences, len(sequences[0]))
+        conservation = pycanal.referenceScores(alignment, ref_seqs,
+                                               method='relative')
+        scale = Hydrophobicity('').aminozuur_dict
+        names, hydrophobicity = [], []
+        for ref_seq in ref_seqs:
+            # The residues at the same sites as the conservation scores
+            reference = alignment[ref_seq]
+            residues = reference[pycanal.referenceColumns(reference)]
+            names.append(self.headers[ref_seq])
+            hydrophobicity.append([scale.get(aa, np.nan) for aa in
+                                   residues.tobytes().decode().upper()])
+        return detectRegions(names, conservation, hydrophobicity,
+                             window=window,
+                             conservation_threshold=conservation_threshold,
+                             hydrophobicity_threshold=hydrophobicity_threshold)
+
     def showPlot(self):
         """
         Shows the plot of the hydrophobicity and conservation of the sequences.
@@ -161,13 +307,17 @@ if "__name__" == "__main__":
                                            'use.')
     argparse.add_argument('iterations',
                           help='The number of iterations to run.')
+    argparse.add_argument('-s', '--strategy', choices=MAFFT_STRATEGIES,
+                          help='The MAFFT strategy to align with. Chosen '
+                               'from the size of the input by default.')
     argparse.add_argument('-p', '--plot', help='Show the plot of the '
                                                'hydrophobicity and '
                                                'conservation of the '
                                                'sequences.',
                           action='store_true')
     args = argparse.parse_args()
-    pipe = Pipeline(args.file, args.database, args.iterations)
+    pipe = Pipeline(args.file, args.database, args.iterations,
+                    align_strategy=args.strategy)
     pipe.run()
     if args.plot:
         pipe.savePlot()
@@ -3,3 +3,4 @@
 __version__ = 0.1
 
 from src.pycanal.pycanal import *
+from src.pycanal.coevolution import *
@@ -0,0 +1,297 @@
+"""
+Coevolution analysis of pairs of sites in the reference sequence of a Canal
+alignment with mutual information (MI) and the average product correction
+(APC).
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+
+import numpy as np
+import pandas as pd
+
+from pycanal.pycanal import _callWorker, _initWorker, letterCodes
+
+COEVOLUTION_MEMORY = 1 << 28  # Bytes of arrays per coevolution process
+
+
+def pairCounts(codes_i, codes_j, num_letters):
+    """
+    Count the residue pairs of two blocks of sites with a product of their
+    one-hot encodings.
+
+    Parameters
+    ------------
+    codes_i, codes_j : numpy array
+        Blocks of the alignment encoded with letterCodes, with one row per
+        sequence and one column per site.
+    num_letters : int
+        Number of letters that are counted.
+
+    Returns
+    ---------
+    counts : numpy array
+        Pair counts in the shape (sites in codes_i, sites in codes_j,
+        num_letters, num_letters).
+    """
+    num_seqs = codes_i.shape[0]
+    onehot_letters = np.eye(num_letters + 1, dtype=np.float32)[:, :num_letters]
+    onehot_i = onehot_letters[codes_i].reshape(num_seqs, -1)
+    onehot_j = onehot_letters[codes_j].reshape(num_seqs, -1)
+    counts = (onehot_i.T @ onehot_j).reshape(
+        codes_i.shape[1], num_letters, codes_j.shape[1], num_letters)
+    return counts.transpose(0, 2, 1, 3)
+
+
+def mutualInformation(counts):
+    """
+    Calculate the mutual information of pairs of sites from their pair
+    counts. Sequences with an uncounted residue at either site of a pair are
+    left out of that pair.
+
+    Parameters
+    ------------
+    counts : numpy array
+        Pair counts with the residues of both sites in the last two axes.
+
+    Returns
+    ---------
+    mi : numpy array
+        The mutual information of each pair.
+    """
+    counts = counts.astype(float)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prob_pair = counts / counts.sum(axis=(-2, -1), keepdims=True)
+        prob_i = prob_pair.sum(axis=-1, keepdims=True)
+        prob_j = prob_pair.sum(axis=-2, keepdims=True)
+        terms = prob_pair * np.log(prob_pair / (prob_i * prob_j))
+    return np.where(np.isfinite(terms), terms, 0).sum(axis=(-2, -1))
+
+
+def blockMutualInformation(letter_codes, num_letters, block_sites, start_i,
+                           start_j):
+    """
+    Calculate the mutual information between two blocks of sites. The MI of
+    a site with itself is set to zero.
+
+    Returns
+    ---------
+    mi : numpy array
+        MI with one row per site in block i and one column per site in
+        block j.
+    """
+    codes_i = letter_codes[:, start_i:start_i + block_sites]
+    codes_j = letter_codes[:, start_j:start_j + block_sites]
+    mi = mutualInformation(pairCounts(codes_i, codes_j, num_letters))
+    if start_i == start_j:
+        np.fill_diagonal(mi, 0)
+    return mi
+
+
+def blockSums(letter_codes, num_letters, block_sites, start_i, start_j):
+    """
+    Calculate the sums of the MI of each site in two blocks with the sites
+    in the other block.
+
+    Returns
+    ---------
+    (sums_i, sums_j) : tuple
+        The MI sums of the sites in block i and in block j.
+    """
+    mi = blockMutualInformation(letter_codes, num_letters, block_sites,
+                                start_i, start_j)
+    return mi.sum(axis=1), mi.sum(axis=0)
+
+
+def blockTopCouplings(letter_codes, num_letters, block_sites, mean_mi,
+                      overall_mean, top, start_i, start_j):
+    """
+    Find the pairs of sites in two blocks with the highest APC corrected MI.
+
+    Returns
+    ---------
+    (sites_i, sites_j, mi, apc) : tuple
+        Arrays with the site indices, MI and APC corrected MI of at most top
+        pairs. Only pairs with site i before site j are considered.
+    """
+    mi = blockMutualInformation(letter_codes, num_letters, block_sites,
+                                start_i, start_j)
+    sites_i = np.arange(start_i, start_i + mi.shape[0])
+    sites_j = np.arange(start_j, start_j + mi.shape[1])
+    apc = mi - np.outer(mean_mi[sites_i], mean_mi[sites_j]) / overall_mean
+    rows, cols = np.nonzero(sites_i[:, None] < sites_j[None, :])
+    keep = selectTop(apc[rows, cols], top)
+    rows, cols = rows[keep], cols[keep]
+    return sites_i[rows], sites_j[cols], mi[rows, cols], apc[rows, cols]
+
+
+def selectTop(values, top):
+    """
+    Get the indices of the highest values, in no particular order.
+    """
+    if len(values) <= top:
+        return np.arange(len(values))
+    return np.argpartition(values, -top)[-top:]
+
+
+class Coevolution:
+    """
+    Class for coevolution analysis of pairs of sites in the reference
+    sequence of a Canal alignment. Pair counts are calculated in blocks of
+    sites with products of one-hot encodings, and blocks can be spread over
+    processes. Only per-site sums and the best pairs of each block are kept,
+    so neither the pair counts nor the MI of all pairs are stored at once.
+
+    Parameters
+    --------------
+    canal : Canal
+        The Canal instance with the alignment to analyze.
+    include : list (default=['-'])
+        Characters counted in addition to the 20 canonical amino acids.
+    block_sites : int or None (default=None)
+        Number of sites per block. If None, blocks are sized from the number
+        of sequences to keep their arrays within COEVOLUTION_MEMORY bytes per
+        process.
+    processes : int or None (default=None)
+        If more than 1, spread the blocks over this many processes.
+
+
+    Example
+    ----------
+    # >>> coevolution = Coevolution(canal, processes=4)
+    # >>> couplings = coevolution.topCouplings(top=50)
+
+    """
+
+    def __init__(self, canal, include=('-',), block_sites=None,
+                 processes=None):
+        self.canal = canal
+        self.letters = list('ACDEFGHIKLMNPQRSTVWY')
+        self.letters.extend(letter for letter in include
+                            if letter not in self.letters)
+        self.block_sites = block_sites
+        self.processes = processes
+
+    def _blockSites(self, num_seqs):
+        """
+        Get the number of sites per block. Half of the memory cap goes to
+        the float32 one-hot encodings of both blocks in every sequence, and
+        half to the pair counts and about six float arrays of probabilities
+        and MI terms per pair of sites.
+
+        Returns
+        ---------
+        block_sites : int
+            The number of sites per block.
+        """
+        if self.block_sites is not None:
+            return self.block_sites
+        num_letters = len(self.letters)
+        by_sequences = COEVOLUTION_MEMORY // 2 // (
+            2 * 4 * num_letters * max(num_seqs, 1))
+        by_pairs = int(np.sqrt(COEVOLUTION_MEMORY // 2 //
+                               (7 * 8 * num_letters ** 2)))
+        return max(1, min(by_sequences, by_pairs))
+
+    def _mapBlocks(self, function, letter_codes, *args):
+        """
+        Apply a block function to every pair of blocks (i, j) with i <= j.
+        Results are yielded as they are calculated, so they can be merged
+        without keeping the results of all blocks.
+
+        Returns
+        ---------
+        results : generator
+            Tuples of (start_i, start_j, result) for every pair of blocks.
+        """
+        block_sites = self._blockSites(letter_codes.shape[0])
+        starts = range(0, letter_codes.shape[1], block_sites)
+        pairs = [(start_i, start_j) for start_i in starts for start_j in starts
+                 if start_i <= start_j]
+        fixed = (len(self.letters), block_sites) + args
+        if self.processes is not None and self.processes > 1 and pairs:
+            starts_i, starts_j = zip(*pairs)
+            with ProcessPoolExecutor(max_workers=self.processes,
+                                     initializer=_initWorker,
+                                     initargs=(letter_codes,)) as pool:
+                results = pool.map(
+                    partial(_callWorker, function),
+                    *[[value] * len(pairs) for value in fixed],
+                    starts_i, starts_j)
+                for (start_i, start_j), result in zip(pairs, results):
+                    yield start_i, start_j, result
+        else:
+            for start_i, start_j in pairs:
+                yield start_i, start_j, function(letter_codes, *fixed,
+                                                 start_i, start_j)
+
+    def meanMutualInformation(self):
+        """
+        Calculate the mean MI of each site with all other sites.
+
+        Returns
+        ---------
+        mean_mi : numpy array
+            The mean MI of each site in the reference sequence.
+        """
+        letter_codes = letterCodes(self.canal.alignment, self.letters)
+        num_sites = letter_codes.shape[1]
+        sums = np.zeros(num_sites)
+        for start_i, start_j, (sums_i, sums_j) in self._mapBlocks(
+                blockSums, letter_codes):
+            sums[start_i:start_i + len(sums_i)] += sums_i
+            if start_i != start_j:
+                sums[start_j:start_j + len(sums_j)] += sums_j
+        return sums / max(num_sites - 1, 1)
+
+    def topCouplings(self, top=100):
+        """
+        Find the pairs of sites with the highest APC corrected MI. The mean
+        MI of every site is calculated in a first pass over the blocks, and
+        the best pairs of each block are selected in a second pass.
+
+        Parameters
+        ------------
+        top : int (default=100)
+            Number of pairs to return.
+
+        Returns
+        ---------
+        couplings : Pandas dataframe
+            The pairs sorted by APC corrected MI, with the positions and
+            reference residues of both sites, the MI and the APC corrected
+            MI.
+        """
+        if self.canal.verbose:
+            print('\nCalculating coevolution of site pairs...')
+
+        mean_mi = self.meanMutualInformation()
+        # Without any MI there is nothing to correct for
+        overall_mean = mean_mi.mean() or 1.0
+        letter_codes = letterCodes(self.canal.alignment, self.letters)
+
+        # Merge the best pairs of each block into the overall best pairs
+        kept = (np.empty(0, dtype=int), np.empty(0, dtype=int), np.empty(0),
+                np.empty(0))
+        for _, _, block in self._mapBlocks(
+                blockTopCouplings, letter_codes,
+                mean_mi, overall_mean, top):
+            kept = [np.concatenate(arrays) for arrays in zip(kept, block)]
+            keep = selectTop(kept[3], top)
+            kept = [array[keep] for array in kept]
+        sites_i, sites_j, mi, apc = kept
+
+        order = np.argsort(-apc, kind='stable')
+        residues = np.array(list(self.canal.reference_sequence))
+        couplings = pd.DataFrame({
+            'site_i': self.canal.sites[sites_i[order]],
+            'site_j': self.canal.sites[sites_j[order]],
+            'residue_i': residues[sites_i[order]],
+            'residue_j': residues[sites_j[order]],
+            'mi': mi[order],
+            'apc': apc[order]})
+
+        if self.canal.verbose:
+            print('Done')
+
+        return couplings
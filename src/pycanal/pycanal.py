@@ -3,7 +3,10 @@ pycanal: A Python package for conservation analysis of homologous proteins
 """
 
 import os
+import time
 import warnings
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 
 import matplotlib.pyplot as plt
 import numpy as np
@@ -14,6 +17,344 @@ import pycanal.utils as utils
 warnings.filterwarnings('ignore')
 pd.set_option('use_inf_as_na', True)  # Treat inf as NaN
 
+# Characters that can be counted in the alignment. All other characters are
+# encoded as UNKNOWN and never counted.
+ALPHABET = 'ACDEFGHIKLMNPQRSTVWYBJOUXZ-'
+UNKNOWN = len(ALPHABET)
+ENCODING = np.full(256, UNKNOWN, dtype=np.uint8)
+ENCODING[np.frombuffer(ALPHABET.encode(), dtype=np.uint8)] = np.arange(UNKNOWN)
+COUNT_CHUNK = 1 << 20  # Alignment cells counted at once
+BOOTSTRAP_MEMORY = 1 << 28  # Bytes of arrays per bootstrap process
+METHODS = ['shannon', 'relative', 'lockless']
+JACKKNIFE_GROUPS = 10  # Groups of sampled sequences for error estimates
+
+
+def alignmentBytes(sequences, length):
+    """
+    Convert aligned sequences to a matrix of ASCII codes.
+
+    Parameters
+    ------------
+    sequences : list
+        Aligned sequences, all of the given length.
+    length : int
+        Number of positions in the alignment.
+
+    Returns
+    ---------
+    alignment : numpy array
+        A uint8 array with one row per sequence and one column per position.
+    """
+    raw = ''.join(sequences).encode('ascii', 'replace')
+    return np.frombuffer(raw, dtype=np.uint8).reshape(len(sequences), length)
+
+
+def countResidues(alignment):
+    """
+    Count the characters of ALPHABET in each column of an alignment of ASCII
+    codes. The alignment is counted in chunks of rows to cap memory use.
+
+    Parameters
+    ------------
+    alignment : numpy array
+        A uint8 array of ASCII codes, as returned by alignmentBytes.
+
+    Returns
+    ---------
+    counts : numpy array
+        An int64 array with one row per character in ALPHABET (plus a last
+        row for unknown characters) and one column per alignment column.
+    """
+    rows, columns = alignment.shape
+    counts = np.zeros((UNKNOWN + 1) * columns, dtype=np.int64)
+    offsets = np.arange(columns)
+    step = max(1, COUNT_CHUNK // max(columns, 1))
+    for start in range(0, rows, step):
+        codes = ENCODING[alignment[start:start + step]].astype(np.int64)
+        counts += np.bincount((codes * columns + offsets).ravel(),
+                              minlength=counts.size)
+    return counts.reshape(UNKNOWN + 1, columns)
+
+
+def letterCodes(alignment, letters):
+    """
+    Encode an alignment of ASCII codes as the index of each residue in a list
+    of letters.
+
+    Parameters
+    ------------
+    alignment : numpy array
+        A uint8 array of ASCII codes, as returned by alignmentBytes.
+    letters : list
+        The characters of ALPHABET that are counted.
+
+    Returns
+    ---------
+    letter_codes : numpy array
+        A uint8 array in the shape of alignment with the index of each
+        residue in letters, or len(letters) for residues not in letters.
+    """
+    lookup = np.full(UNKNOWN + 1, len(letters), dtype=np.uint8)
+    lookup[[ALPHABET.index(letter) for letter in letters]] = np.arange(
+        len(letters))
+    return lookup[ENCODING[alignment]]
+
+
+def siteFrequencies(site_counts):
+    """
+    Normalize residue counts to frequencies per site. Sites without any
+    counted residue get NaN frequencies.
+
+    Parameters
+    ------------
+    site_counts : numpy array
+        Residue counts with one row per amino acid and one column per site.
+
+    Returns
+    ---------
+    site_freqs : numpy array
+        The frequencies, in the same shape as site_counts.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return site_counts / site_counts.sum(axis=0)
+
+
+def scoreSites(prob_site, prob_msa, method):
+    """
+    Calculate conservation scores from amino acid probabilities. Terms that
+    are not finite (i.e. from amino acids absent at a site) count as zero.
+
+    Parameters
+    ------------
+    prob_site : numpy array
+        Probabilities of the amino acids with one row per site and one column
+        per amino acid.
+    prob_msa : numpy array
+        Probabilities of the amino acids in the entire alignment.
+    method : str {'shannon', 'relative', 'lockless'}
+        Method for calculating conservation scores.
+
+    Returns
+    ---------
+    scores : numpy array
+        The conservation score of each site.
+    """
+    with np.errstate(divide='ignore', invalid='ignore', over='ignore'):
+        if method == 'shannon':
+            terms = prob_site * np.log(prob_site)
+        elif method == 'relative':
+            terms = prob_site * np.log(prob_site / prob_msa)
+        elif method == 'lockless':
+            terms = np.log(prob_site / prob_msa) ** 2
+        else:
+            raise ValueError(f'Unknown conservation method {method}.')
+    scores = np.where(np.isfinite(terms), terms, 0).sum(axis=-1)
+    if method == 'shannon':
+        return -scores
+    if method == 'lockless':
+        return np.sqrt(scores)
+    return scores
+
+
+def replicateScores(letter_codes, weights, num_letters, methods,
+                    block_sites):
+    """
+    Calculate the conservation scores of weighted replicates of an alignment.
+    The residue counts of all replicates are computed at once as products of
+    the weights with a one-hot encoding of the alignment, one block of sites
+    at a time.
+
+    Parameters
+    ------------
+    letter_codes : numpy array
+        The alignment with one row per sequence and one column per site,
+        encoded as the index of each residue in the amino acid letters, or
+        num_letters for residues that are not counted.
+    weights : numpy array
+        The weight of each sequence, with one row per replicate.
+    num_letters : int
+        Number of amino acid letters that are counted.
+    methods : list
+        Methods for calculating conservation scores.
+    block_sites : int
+        Number of sites that are one-hot encoded at once.
+
+    Returns
+    ---------
+    scores : dict
+        The scores of each method, with one row per replicate and one column
+        per site.
+    """
+    num_seqs, num_sites = letter_codes.shape
+    replicates = weights.shape[0]
+    weights = weights.astype(float)
+    onehot_letters = np.eye(num_letters + 1)[:, :num_letters]
+    counts = np.empty((replicates, num_sites, num_letters))
+    for start in range(0, num_sites, block_sites):
+        block = letter_codes[:, start:start + block_sites]
+        onehot = onehot_letters[block].reshape(num_seqs, -1)
+        counts[:, start:start + block.shape[1]] = (weights @ onehot).reshape(
+            replicates, block.shape[1], num_letters)
+        # Free the encoding before the next block is encoded
+        del onehot
+    return scoreCounts(counts, methods)
+
+
+def scoreCounts(counts, methods):
+    """
+    Calculate the conservation scores of several sets of residue counts at
+    once.
+
+    Parameters
+    ------------
+    counts : numpy array
+        Residue counts in the shape (sets, sites, amino acids).
+    methods : list
+        Methods for calculating conservation scores.
+
+    Returns
+    ---------
+    scores : dict
+        The scores of each method, with one row per set and one column per
+        site.
+    """
+    msa_counts = counts.sum(axis=1, keepdims=True)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        prob_site = counts / counts.sum(axis=2, keepdims=True)
+        prob_msa = msa_counts / msa_counts.sum(axis=2, keepdims=True)
+    return {method: scoreSites(prob_site, prob_msa, method)
+            for method in methods}
+
+
+def referenceColumns(reference):
+    """
+    Get the columns of an alignment with a residue in the reference
+    sequence, i.e. the sites of the reference.
+
+    Parameters
+    ------------
+    reference : numpy array
+        The row of the reference sequence in an alignment of ASCII codes, as
+        returned by alignmentBytes.
+
+    Returns
+    ---------
+    site_columns : numpy array
+        The indices of the columns with a letter in the reference sequence.
+    """
+    reference = reference | 0x20  # Lowercase letters
+    return np.flatnonzero((reference >= ord('a')) & (reference <= ord('z')))
+
+
+def referenceScores(alignment, refs, method='relative', include=None):
+    """
+    Calculate the conservation scores of the sites of several reference
+    sequences of one alignment. The alignment is counted once and the
+    counts of the sites of each reference are taken from those counts, so
+    the scores equal those of Canal.analysis with each reference.
+
+    Parameters
+    ------------
+    alignment : numpy array
+        A uint8 array of ASCII codes, as returned by alignmentBytes.
+    refs : list
+        Positions of the reference sequences in the alignment.
+    method : str {'shannon', 'relative', 'lockless'}
+        Method for calculating conservation scores.
+    include : list or None (default=None)
+        List of characters to count in addition to the 20 canonical amino
+        acids. Ignored if `None`.
+
+    Returns
+    ---------
+    scores : list
+        The scores of the sites of each reference sequence.
+    """
+    letters = list('ACDEFGHIKLMNPQRSTVWY')
+    letters.extend(letter for letter in include or ()
+                   if letter not in letters)
+    counts = countResidues(alignment)[[ALPHABET.index(letter)
+                                       for letter in letters]]
+    scores = []
+    for ref in refs:
+        site_counts = counts[:, referenceColumns(alignment[ref])]
+        msa_counts = site_counts.sum(axis=1).astype(float)
+        prob_site = np.ascontiguousarray(siteFrequencies(site_counts).T)
+        scores.append(scoreSites(prob_site, msa_counts / msa_counts.sum(),
+                                 method))
+    return scores
+
+
+def samplingOrder(num_seqs, clusters=None, seed=None):
+    """
+    Get a random order in which to sample the sequences of an alignment. If
+    clusters are given, every prefix of the order holds each cluster in
+    proportion to its size (stratified sampling).
+
+    Parameters
+    ------------
+    num_seqs : int
+        Number of sequences in the alignment.
+    clusters : list or None (default=None)
+        Cluster label of every sequence. If None, sample uniformly.
+    seed : int or None (default=None)
+        Seed of the random number generator.
+
+    Returns
+    ---------
+    order : numpy array
+        The indices of all sequences in sampling order.
+    """
+    rng = np.random.default_rng(seed)
+    if clusters is None:
+        return rng.permutation(num_seqs)
+    _, labels = np.unique(np.asarray(clusters), return_inverse=True)
+    assert len(labels) == num_seqs, 'There must be a cluster label for ' \
+                                    'every sequence.'
+    # Spread the members of each cluster evenly over (0, 1) in random order
+    positions = np.empty(num_seqs)
+    for label in range(labels.max() + 1):
+        members = np.flatnonzero(labels == label)
+        positions[members] = (rng.permutation(len(members)) + rng.random()) \
+            / len(members)
+    return np.argsort(positions, kind='stable')
+
+
+def bootstrapChunk(letter_codes, seed, replicates, num_letters, methods,
+                   block_sites):
+    """
+    Draw multinomial sequence weights for a chunk of bootstrap replicates
+    and calculate their conservation scores. See replicateScores.
+    """
+    num_seqs = letter_codes.shape[0]
+    rng = np.random.default_rng(seed)
+    weights = rng.multinomial(num_seqs, np.full(num_seqs, 1 / num_seqs),
+                              size=replicates)
+    return replicateScores(letter_codes, weights, num_letters, methods,
+                           block_sites)
+
+
+_worker_letter_codes = None
+
+
+def _initWorker(letter_codes):
+    """
+    Keep the encoded alignment in a worker process, so it is sent once per
+    worker instead of once per task. Used by the bootstrap and coevolution
+    process pools.
+    """
+    global _worker_letter_codes
+    _worker_letter_codes = letter_codes
+
+
+def _callWorker(function, *args):
+    """
+    Run a function on the encoded alignment of a worker process, as
+    function(letter_codes, *args). Pass functools.partial(_callWorker,
+    function) to the pool.
+    """
+    return function(_worker_letter_codes, *args)
+
 
 class Canal:
     """
@@ -120,6 +461,11 @@ class Canal:
                 f' residue is labeled as position {startcount}')
             print(f'\nReference sequence residues are labeled as {startlabel}')
 
+        # Keep the alignment at the sites in the reference sequence as ASCII
+        # codes, and the residue counts of every site
+        alignment = alignmentBytes(sequences, len(sequences[ref]))
+        site_columns = referenceColumns(alignment[ref])
+
         # Initialize
         self.fastafile = fastafile
         self.ref = ref
@@ -127,7 +473,59 @@ class Canal:
         self.verbose = verbose
         self.reference_sequence = reference_sequence
         self.reference_header = headers[ref]
-        self.site_freqs = self.msa_freqs = self.alignment_df = None
+        self.headers = list(headers)
+        self.alignment_length = len(sequences[ref])
+        self.site_columns = site_columns
+        self.sites = np.arange(startcount, startcount + len(site_columns))
+        self.alignment = alignment[:, site_columns].copy()
+        self._counts = None
+        self.site_freqs = self.msa_freqs = self.cons_scores = None
+        self.cons_errors = self.sampled_sequences = None
+
+    @property
+    def counts(self):
+        """
+        The residue counts of every site, as returned by countResidues. The
+        alignment is counted on first use, so approximateAnalysis only counts
+        the sequences it samples.
+        """
+        if self._counts is None:
+            self._counts = countResidues(self.alignment)
+        return self._counts
+
+    @property
+    def alignment_df(self):
+        """
+        The alignment at the sites in the reference sequence as a dataframe of
+        characters, or None if the frequencies have not been calculated.
+        Indices are the sequence descriptions, columns are the sites.
+        """
+        if self.site_freqs is None:
+            return None
+        return pd.DataFrame(self.alignment.view('S1').astype('U1'),
+                            index=self.headers, columns=self.sites)
+
+    def _includeLetters(self, include):
+        """
+        Add the characters in include to the amino acid letters that are
+        counted.
+        """
+        if include is None:
+            return
+        unknown = [letter for letter in include if letter not in ALPHABET]
+        if unknown:
+            raise ValueError(f'Cannot include {unknown}, only characters '
+                             f'in {ALPHABET} can be counted.')
+        self.aminoacid_letters.extend(
+            letter for letter in include
+            if letter not in self.aminoacid_letters)
+
+    def _letterRows(self):
+        """
+        Get the rows of the count matrix of the amino acids in
+        aminoacid_letters.
+        """
+        return [ALPHABET.index(letter) for letter in self.aminoacid_letters]
 
     def calcFrequencies(self, include=None):
         """
@@ -164,55 +562,20 @@ class Canal:
             print('\nCalculating amino acid frequencies...')
 
         # Amino acids to calculate frequencies
+        self._includeLetters(include)
 
-        if include is not None:
-            self.aminoacid_letters.extend(include)
-
-        # Read alignment as dataframe
-        fasta_df = utils.read_fasta_as_df(self.fastafile)
-
-        # Only use sites in reference sequence
-        refseq_residue_positions = [i for i in range(fasta_df.shape[1]) \
-                                    if fasta_df.iloc[self.ref, i].isalpha()]
-        fasta_df = fasta_df.iloc[:, refseq_residue_positions]
-
-        # Renumber sites using reference sequence numbering
-        fasta_df.columns = np.arange(self.startcount,
-                                     self.startcount + fasta_df.shape[1])
-
-        # Calculate site frequencies
-        site_counts = pd.DataFrame(index=self.aminoacid_letters, dtype=float)
-        for col in fasta_df.columns:
-            counts = np.unique(fasta_df[col], return_counts=True)
-            counts = pd.Series(counts[1], index=counts[0])
-            site_counts[col] = counts.reindex(np.array(self.aminoacid_letters))
-        site_counts = site_counts.fillna(0)
-        site_freqs = site_counts / site_counts.sum()
-        # self.site_frequencies = site_freqs
+        # Calculate site frequencies from the stored residue counts
+        site_counts = self.counts[self._letterRows()]
+        site_freqs = pd.DataFrame(siteFrequencies(site_counts),
+                                  index=self.aminoacid_letters,
+                                  columns=self.sites)
 
         # Calculate MSA frequencies
-        all_sites = fasta_df.values.reshape(-1)
-        msa_counts = np.unique(all_sites, return_counts=True)
-        msa_counts = pd.Series(msa_counts[1], index=msa_counts[0])
-        msa_freqs = pd.DataFrame(index=self.aminoacid_letters, dtype=float)
-        """
-        Starting of patch written by DWJ Straat
-        """
-        letters = self.aminoacid_letters
-        for letter in letters:
-            if letter not in msa_counts.index:
-                msa_counts[letter] = 0
-        """
-        End of patch
-        """
-        msa_freqs['msa_freqs'] = msa_counts[np.array(self.aminoacid_letters)]
-        msa_freqs['msa_freqs'] = msa_freqs['msa_freqs'] / msa_freqs[
-            'msa_freqs'].sum()
+        msa_freqs = self._msaFrequencies(site_counts)
 
         if self.verbose:
             print('Done.')
 
-        self.alignment_df = fasta_df
         self.site_freqs = site_freqs
         self.msa_freqs = msa_freqs
 
@@ -285,25 +648,11 @@ class Canal:
             msa_freqs.index), 'site_freqs and msa_freqs' \
                               ' must have identical indices'
 
-        # Calculate conservation scores
-        cons_scores = []
-        prob_msa = msa_freqs.iloc[:,
-                   0]  # Probability of amino acid occurence in MSA
-        for col in site_freqs.columns:
-            prob_site = site_freqs[
-                col]  # Probability of amino acid occurence in site
-
-            if method == 'shannon':
-                score = -np.sum((prob_site * np.log(prob_site)).fillna(0))
-            elif method == 'relative':
-                score = np.sum(
-                    (prob_site * np.log(prob_site / prob_msa)).fillna(0))
-            elif method == 'lockless':
-                score = np.sqrt(
-                    np.sum(((np.log(prob_site / prob_msa)) ** 2).fillna(0)))
-
-            cons_scores.append(score)
-        cons_scores = pd.DataFrame(cons_scores, index=site_freqs.columns,
+        # Calculate conservation scores of all sites at once
+        prob_msa = msa_freqs.iloc[:, 0].values  # Probability in MSA
+        prob_site = np.ascontiguousarray(site_freqs.values.T)  # Per site
+        cons_scores = pd.DataFrame(scoreSites(prob_site, prob_msa, method),
+                                   index=site_freqs.columns,
                                    columns=[method])
 
         # Print progress
@@ -312,7 +661,8 @@ class Canal:
 
         return cons_scores
 
-    def analysis(self, include=None, method='relative'):
+    def analysis(self, include=None, method='relative', approximate=False,
+                 tolerance=0.01, time_budget=None, clusters=None, seed=None):
         """Carry out conservation analysis by calculating conservation scores
         from the
         alignment for each site in the reference sequence. By default, only
@@ -349,6 +699,9 @@ class Canal:
             and lower variability at the site.
 
             If 'all', calculate all the above mentioned conservation scores.
+        approximate : bool (default=False)
+            If True, estimate the scores from a sample of the sequences with
+            approximateAnalysis. The other parameters are passed on to it.
 
 
         Returns
@@ -359,6 +712,12 @@ class Canal:
             reference sequence. Columns are the conservation analysis methods.
         """
 
+        if approximate:
+            return self.approximateAnalysis(include=include, method=method,
+                                            tolerance=tolerance,
+                                            time_budget=time_budget,
+                                            clusters=clusters, seed=seed)
+
         # Calculate amino acid frequencies
         site_freqs, msa_freqs = self.calcFrequencies(include=include)
         self.site_freqs = site_freqs
@@ -370,15 +729,348 @@ class Canal:
                                                       method=method)
         else:
             cons_scores = pd.DataFrame(index=site_freqs.columns, dtype=float)
-            for each_method in ['shannon', 'relative', 'lockless']:
+            for each_method in METHODS:
                 each_cons_scores = self.calcConservationScores(site_freqs,
                                                                msa_freqs,
                                                                method=
                                                                each_method)
                 cons_scores[each_method] = each_cons_scores.iloc[:, 0]
 
+        self.cons_scores = cons_scores
+        return cons_scores.copy()
+
+    def approximateAnalysis(self, include=None, method='relative',
+                            tolerance=0.01, time_budget=None, clusters=None,
+                            batch_size=1000, seed=None):
+        """Estimate the conservation scores from a growing random sample of
+        the sequences. Batches of sequences, doubling in size, are added to
+        the sample until the estimated error of every site is within the
+        tolerance, the time budget is spent or all sequences are sampled, in
+        which case the scores equal those of analysis.
+
+        Errors are standard errors from a delete-a-group jackknife over
+        JACKKNIFE_GROUPS groups of the sample, with a finite population
+        correction so they shrink to zero as the sample grows to the whole
+        alignment. The errors are stored in cons_errors.
+
+        Parameters
+        ------------
+        include : list or None (default=None)
+            List of characters to include in analysis. Ignored if `None`.
+        method : str {'shannon', 'relative', 'lockless', 'all'}
+            Method for calculating conservation scores. See analysis.
+        tolerance : float or None (default=0.01)
+            Largest accepted standard error of any site, as a fraction of
+            the largest absolute score of each method. If None, only the
+            time budget stops sampling.
+        time_budget : float or None (default=None)
+            Seconds to spend sampling. Batches are shrunk to the number of
+            sequences expected to fit in the remaining time. The first batch
+            is always sampled. Ignored if None.
+        clusters : list or None (default=None)
+            Cluster label of every sequence, to sample each cluster in
+            proportion to its size. If None, sample uniformly.
+        batch_size : int (default=1000)
+            Number of sequences in the first batch.
+        seed : int or None (default=None)
+            Seed of the random number generator.
+
+        Returns
+        ---------
+        cons_scores : Pandas dataframe
+            A Pandas dataframe of estimated conservation scores. Indices are
+            the positions in the reference sequence. Columns are the
+            conservation analysis methods.
+        """
+        start_time = time.perf_counter()
+
+        # Print progress
+        if self.verbose:
+            print(f'\nEstimating conservation scores with {method} '
+                  f'method...')
+
+        methods = METHODS if method == 'all' else [method]
+        self._includeLetters(include)
+        rows = self._letterRows()
+        num_seqs = self.alignment.shape[0]
+        order = samplingOrder(num_seqs, clusters=clusters, seed=seed)
+
+        # Count the residues of each jackknife group while sampling
+        group_counts = np.zeros((JACKKNIFE_GROUPS, UNKNOWN + 1,
+                                 self.alignment.shape[1]), dtype=np.int64)
+        sampled = 0
+        while sampled < num_seqs:
+            batch = order[sampled:sampled + batch_size]
+            for group in range(JACKKNIFE_GROUPS):
+                group_rows = batch[(sampled + np.arange(len(batch)))
+                                   % JACKKNIFE_GROUPS == group]
+                group_counts[group] += countResidues(
+                    self.alignment[np.sort(group_rows)])
+            sampled += len(batch)
+            batch_size *= 2
+
+            # Score the sample and the sample without each group
+            counts = group_counts.sum(axis=0)[rows]
+            leave_out = counts - group_counts[:, rows]
+            sets = np.concatenate([counts[None], leave_out])
+            scores = scoreCounts(
+                np.ascontiguousarray(sets.transpose(0, 2, 1), dtype=float),
+                methods)
+            correction = np.sqrt(1 - sampled / num_seqs)
+            errors, within_tolerance = {}, tolerance is not None
+            for each_method in methods:
+                jackknife = scores[each_method][1:]
+                errors[each_method] = correction * np.sqrt(
+                    (JACKKNIFE_GROUPS - 1) / JACKKNIFE_GROUPS *
+                    ((jackknife - jackknife.mean(axis=0)) ** 2).sum(axis=0))
+                # The methods have different scales, so errors are compared
+                # to the largest score of each method
+                if within_tolerance:
+                    scale = np.nanmax(np.abs(scores[each_method][0]),
+                                      initial=0)
+                    within_tolerance = np.nanmax(
+                        errors[each_method], initial=0) <= tolerance * scale
+            if within_tolerance:
+                break
+            if time_budget is not None:
+                # Only sample as many sequences as fit in the rest of the
+                # budget at the rate observed so far
+                elapsed = time.perf_counter() - start_time
+                batch_size = min(batch_size, int(
+                    (time_budget - elapsed) * sampled / elapsed))
+                if batch_size < 1:
+                    break
+
+        cons_scores = pd.DataFrame(
+            {each_method: scores[each_method][0] for each_method in methods},
+            index=self.sites)
+        self.cons_errors = pd.DataFrame(errors, index=self.sites)
+        self.sampled_sequences = sampled
+
+        # Print progress
+        if self.verbose:
+            print(f'Done, sampled {sampled} of {num_seqs} sequences')
+
         return cons_scores
 
+    def _msaFrequencies(self, site_counts):
+        """
+        Calculate the frequencies of the amino acids in the entire alignment
+        from the residue counts of each site.
+        """
+        msa_counts = site_counts.sum(axis=1).astype(float)
+        return pd.DataFrame({'msa_freqs': msa_counts / msa_counts.sum()},
+                            index=self.aminoacid_letters)
+
+    def _updateCounts(self, delta):
+        """
+        Add a change in residue counts to the stored counts, and update the
+        frequencies and conservation scores of the last analysis. Only sites
+        whose counts changed are rescored, except for the 'relative' and
+        'lockless' scores when the MSA frequencies changed, since those depend
+        on the MSA frequencies at every site.
+        """
+        if self._counts is None:
+            # Not counted yet, the updated alignment is counted on first use
+            return None
+        self._counts += delta
+        if self.site_freqs is None:
+            return None
+
+        # Update frequencies of the sites whose counts changed
+        rows = self._letterRows()
+        site_counts = self.counts[rows]
+        changed = np.flatnonzero(delta[rows].any(axis=0))
+        self.site_freqs.iloc[:, changed] = siteFrequencies(
+            site_counts[:, changed])
+        msa_freqs = self._msaFrequencies(site_counts)
+        msa_changed = not np.array_equal(msa_freqs.values,
+                                         self.msa_freqs.values,
+                                         equal_nan=True)
+        self.msa_freqs = msa_freqs
+        if self.cons_scores is None:
+            return None
+
+        # Rescore the affected sites
+        prob_msa = msa_freqs.iloc[:, 0].values
+        all_sites = np.arange(len(self.sites))
+        for col, method in enumerate(self.cons_scores.columns):
+            sites = all_sites if msa_changed and method != 'shannon' \
+                else changed
+            prob_site = np.ascontiguousarray(
+                self.site_freqs.values[:, sites].T)
+            self.cons_scores.iloc[sites, col] = scoreSites(prob_site,
+                                                           prob_msa, method)
+        return self.cons_scores.copy()
+
+    def addSequences(self, headers, sequences):
+        """Add aligned sequences to the alignment. The residue counts are
+        updated with the new sequences only, and if an analysis has been
+        carried out, its frequencies and conservation scores are updated for
+        the affected sites. The results are identical to those of a new
+        analysis of the whole alignment.
+
+        Parameters
+        ------------
+        headers : list
+            Descriptions of the sequences to add.
+        sequences : list
+            Sequences to add. They must be aligned to the existing alignment,
+            i.e. have the same number of positions (including gaps).
+
+        Returns
+        ---------
+        cons_scores : Pandas dataframe or None
+            The updated conservation scores of the last analysis, or None if
+            no analysis has been carried out.
+        """
+        assert len(headers) == len(sequences), 'There must be an equal ' \
+                                               'number of sequences and ' \
+                                               'descriptions.'
+        assert all(len(seq) == self.alignment_length for seq in sequences), \
+            f'Sequences must be aligned to the {self.alignment_length} ' \
+            f'positions of the alignment.'
+        added = alignmentBytes(sequences, self.alignment_length)
+        added = added[:, self.site_columns]
+        self.alignment = np.vstack([self.alignment, added])
+        self.headers.extend(headers)
+        return self._updateCounts(countResidues(added))
+
+    def removeSequences(self, sequences):
+        """Remove sequences from the alignment. The residue counts are
+        updated with the removed sequences only, and if an analysis has been
+        carried out, its frequencies and conservation scores are updated for
+        the affected sites. The reference sequence cannot be removed.
+
+        Parameters
+        ------------
+        sequences : list
+            Positions in the alignment (negative positions count from the
+            end) or descriptions of the sequences to remove. A description
+            removes every sequence with that description.
+
+        Returns
+        ---------
+        cons_scores : Pandas dataframe or None
+            The updated conservation scores of the last analysis, or None if
+            no analysis has been carried out.
+        """
+        num_seqs = len(self.headers)
+        rows = set()
+        for seq in sequences:
+            if isinstance(seq, str):
+                matches = [i for i, head in enumerate(self.headers)
+                           if head == seq]
+                if not matches:
+                    raise ValueError(f'There is no sequence described as '
+                                     f'{seq}.')
+                rows.update(matches)
+            elif -num_seqs <= int(seq) < num_seqs:
+                rows.add(int(seq) % num_seqs)
+            else:
+                raise IndexError(f'Sequence position {seq} is out of range '
+                                 f'for {num_seqs} sequences.')
+        rows = sorted(rows)
+        assert self.ref not in rows, 'The reference sequence cannot be ' \
+                                     'removed.'
+        delta = countResidues(self.alignment[rows])
+        self.alignment = np.delete(self.alignment, rows, axis=0)
+        removed = set(rows)
+        self.headers = [head for i, head in enumerate(self.headers)
+                        if i not in removed]
+        self.ref -= sum(row < self.ref for row in rows)
+        return self._updateCounts(-delta)
+
+    def bootstrap(self, replicates=100, include=None, method='all',
+                  quantiles=(0.025, 0.5, 0.975), chunk_size=None,
+                  processes=None, seed=None):
+        """Estimate confidence intervals of the conservation scores by
+        bootstrapping the sequences in the alignment. Every replicate
+        resamples the sequences with multinomial weights, and the scores of a
+        chunk of replicates are calculated at once with array operations.
+
+        Parameters
+        ------------
+        replicates : int (default=100)
+            Number of bootstrap replicates.
+        include : list or None (default=None)
+            List of characters to include in analysis. Ignored if `None`.
+        method : str {'shannon', 'relative', 'lockless', 'all'}
+            Method for calculating conservation scores. See analysis.
+        quantiles : tuple (default=(0.025, 0.5, 0.975))
+            Quantiles of the replicate scores to return for each site.
+        chunk_size : int or None (default=None)
+            Number of replicates calculated at once. If None, chunks are sized
+            from the number of sequences and sites to keep their arrays
+            within BOOTSTRAP_MEMORY bytes per process.
+        processes : int or None (default=None)
+            If more than 1, spread the chunks over this many processes.
+        seed : int or None (default=None)
+            Seed of the random number generator. Results for a seed and
+            chunk_size do not depend on the number of processes.
+
+        Returns
+        ---------
+        intervals : Pandas dataframe
+            Indices are the positions in the reference sequence. Columns are
+            a (method, quantile) multi-index.
+        """
+
+        # Print progress
+        if self.verbose:
+            print(f'\nBootstrapping conservation scores with {replicates} '
+                  f'replicates...')
+
+        methods = METHODS if method == 'all' else [method]
+        self._includeLetters(include)
+        num_letters = len(self.aminoacid_letters)
+        letter_codes = letterCodes(self.alignment, self.aminoacid_letters)
+        num_seqs, num_sites = letter_codes.shape
+
+        # Size the chunks of replicates and blocks of sites so each uses at
+        # most half of the memory cap. Per replicate, a chunk holds the int64
+        # weights and their float copy (one value per sequence) and up to six
+        # float arrays of counts, probabilities and score terms (one value
+        # per site and amino acid). A block holds the one-hot encoding of
+        # its sites in every sequence.
+        if chunk_size is None:
+            replicate_bytes = 8 * (2 * num_seqs + 6 * num_sites * num_letters)
+            chunk_size = BOOTSTRAP_MEMORY // 2 // replicate_bytes
+        chunk_size = max(1, min(chunk_size, replicates))
+        block_sites = max(1, BOOTSTRAP_MEMORY // 2 //
+                          (8 * num_letters * max(num_seqs, 1)))
+        sizes = [min(chunk_size, replicates - start)
+                 for start in range(0, replicates, chunk_size)]
+        seeds = np.random.SeedSequence(seed).spawn(len(sizes))
+        chunk_args = [(chunk_seed, size, num_letters, methods, block_sites)
+                      for chunk_seed, size in zip(seeds, sizes)]
+
+        # Calculate scores of all replicates
+        if processes is not None and processes > 1:
+            with ProcessPoolExecutor(max_workers=processes,
+                                     initializer=_initWorker,
+                                     initargs=(letter_codes,)) as pool:
+                chunks = list(pool.map(partial(_callWorker, bootstrapChunk),
+                                       *zip(*chunk_args)))
+        else:
+            chunks = [bootstrapChunk(letter_codes, *args)
+                      for args in chunk_args]
+
+        # Summarize replicate scores as quantiles
+        intervals = pd.DataFrame(
+            index=self.sites, dtype=float,
+            columns=pd.MultiIndex.from_product([methods, list(quantiles)]))
+        for each_method in methods:
+            scores = np.concatenate([chunk[each_method] for chunk in chunks])
+            intervals[each_method] = np.nanquantile(scores, quantiles,
+                                                    axis=0).T
+
+        # Print progress
+        if self.verbose:
+            print('Done')
+
+        return intervals
+
     def plotSiteDistribution(self, site, saveplot=None):
         """Plot the amino acid distribution at a specific site in the
         alignment. The
@@ -466,7 +1158,7 @@ class Canal:
         """
 
         # Ensure that site_freqs is not None
-        if self.alignment_df is None:
+        if self.site_freqs is None:
             raise NotImplementedError(
                 "Cannot determine consensus sequence since neither"
                 " 'calcFrequencies' nor 'analysis' methods have"
@@ -0,0 +1,76 @@
+"""
+Utility functions for reading and writing fasta files
+"""
+
+import pandas as pd
+
+from compression import openText
+
+
+def read_fasta(fasta, return_as_dict=False):
+    """
+    Read the protein sequences in a fasta file. Gzip and BGZF compressed
+    files are parsed while they are being decompressed.
+
+    Parameters
+    -----------
+    fasta : str
+        Path to the (optionally compressed) fasta file.
+    return_as_dict : bool (default=False)
+        If True, return a dictionary of headers and sequences.
+
+    Returns
+    ---------
+    (headers, sequences) : tuple
+        A tuple of lists of the headers and sequences in the fasta file.
+    """
+    headers, sequences = [], []
+    with openText(fasta) as fast:
+        for line in fast:
+            if line.startswith('>'):
+                headers.append(line.replace('>', '').strip())
+                sequences.append([])
+            else:
+                seq = line.strip()
+                if len(seq) > 0:
+                    sequences[-1].append(seq)
+    sequences = [''.join(seq) for seq in sequences]
+    if return_as_dict:
+        return dict(zip(headers, sequences))
+    return headers, sequences
+
+
+def read_fasta_as_df(fasta):
+    """
+    Read the aligned sequences in a fasta file as a dataframe.
+
+    Parameters
+    -----------
+    fasta : str
+        Path to the (optionally compressed) fasta file.
+
+    Returns
+    ---------
+    fasta_df : Pandas dataframe
+        Indices are the headers, columns are the positions in the alignment.
+    """
+    heads, sequences = read_fasta(fasta)
+    return pd.DataFrame([list(seq) for seq in sequences], index=heads)
+
+
+def write_fasta(headers, sequences, path):
+    """
+    Write sequences to a fasta file.
+
+    Parameters
+    -----------
+    headers : list
+        The headers of the sequences.
+    sequences : list
+        The sequences to write.
+    path : str
+        Path of the fasta file to write.
+    """
+    with open(path, 'w') as fasta:
+        for head, seq in zip(headers, sequences):
+            fasta.write(f'>{head}\n{seq}\n')
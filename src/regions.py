@@ -0,0 +1,149 @@
+"""
+A module to find regions of a protein that are both conserved and
+hydrophobic, such as candidate transmembrane segments, from sliding window
+means of the conservation and hydrophobicity of each site.
+Written by: David Straat
+"""
+
+import numpy as np
+import pandas as pd
+
+SEGMENT_COLUMNS = ['reference', 'start', 'end', 'length', 'conservation',
+                   'hydrophobicity']
+
+
+def padTracks(tracks):
+    """
+    Stack tracks of different lengths into one array, padded with NaN.
+    :param tracks: A list of 1D sequences of per-site values.
+    :return: A tuple of the padded 2D array and the length of each track.
+    """
+    lengths = np.array([len(track) for track in tracks], dtype=int)
+    padded = np.full((len(tracks), lengths.max(initial=0)), np.nan)
+    for row, track in enumerate(tracks):
+        padded[row, :lengths[row]] = np.asarray(track, dtype=float)
+    return padded, lengths
+
+
+def prefixSums(values):
+    """
+    Calculate prefix sums of the values and of the number of values along
+    the last axis, leaving out NaN values.
+    :param values: A 2D array of values.
+    :return: A tuple of the prefix sums of the values and of the counts, both
+    with a leading zero column.
+    """
+    valid = ~np.isnan(values)
+    sums = np.zeros((values.shape[0], values.shape[1] + 1))
+    counts = np.zeros((values.shape[0], values.shape[1] + 1))
+    np.cumsum(np.where(valid, values, 0), axis=1, out=sums[:, 1:])
+    np.cumsum(valid, axis=1, out=counts[:, 1:])
+    return sums, counts
+
+
+def rangeMeans(sums, counts, rows, starts, ends):
+    """
+    Calculate the means of ranges of positions from prefix sums.
+    :param sums: Prefix sums of the values, as returned by prefixSums.
+    :param counts: Prefix sums of the counts, as returned by prefixSums.
+    :param rows: The row of each range.
+    :param starts: The first position of each range.
+    :param ends: The position after the last position of each range.
+    :return: The mean of the values in each range, NaN for ranges without
+    values.
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return (sums[rows, ends] - sums[rows, starts]) / \
+            (counts[rows, ends] - counts[rows, starts])
+
+
+def windowMeans(values, lengths, window):
+    """
+    Calculate the sliding window means of a batch of padded tracks in O(n)
+    with prefix sums.
+    :param values: A 2D array of tracks, padded with NaN.
+    :param lengths: The length of each track.
+    :param window: The number of sites in a window.
+    :return: A 2D array with the mean of each window, by the position of its
+    first site. Windows that run past the end of their track are NaN.
+    """
+    sums, counts = prefixSums(values)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        means = (sums[:, window:] - sums[:, :-window]) / \
+            (counts[:, window:] - counts[:, :-window])
+    starts = np.arange(means.shape[1])
+    means[starts[None, :] > (lengths - window)[:, None]] = np.nan
+    return means
+
+
+def detectRegions(names, conservation, hydrophobicity, window=19,
+                  conservation_threshold=None, hydrophobicity_threshold=1.6):
+    """
+    Find the segments of a batch of proteins where the window means of the
+    conservation and hydrophobicity exceed the thresholds. A segment is a run
+    of sites covered by passing windows, so overlapping and adjacent windows
+    are merged. All proteins are handled at once with array operations.
+    :param names: The name of each protein.
+    :param conservation: A list with the conservation of each site of each
+    protein.
+    :param hydrophobicity: A list with the hydrophobicity of each site of
+    each protein.
+    :param window: The number of sites in a window. Defaults to 19, the
+    length of a transmembrane helix.
+    :param conservation_threshold: The minimum window mean of the
+    conservation. Defaults to None, meaning it is not used.
+    :param hydrophobicity_threshold: The minimum window mean of the
+    hydrophobicity. Defaults to 1.6, the Kyte-Doolittle threshold for
+    transmembrane segments. None means it is not used.
+    :return: A pandas dataframe with one row per segment, giving the name of
+    the protein, the first and last position (counted from 1), the length
+    and the mean conservation and hydrophobicity of the segment.
+    """
+    if len(names) == 0:
+        return pd.DataFrame(columns=SEGMENT_COLUMNS)
+    cons_values, lengths = padTracks(conservation)
+    hydro_values, hydro_lengths = padTracks(hydrophobicity)
+    if not np.array_equal(lengths, hydro_lengths):
+        raise ValueError('The conservation and hydrophobicity of each '
+                         'protein must have the same length.')
+    if cons_values.shape[1] < window:
+        return pd.DataFrame(columns=SEGMENT_COLUMNS)
+
+    # Find the windows that pass all thresholds
+    passing = np.ones((len(names), cons_values.shape[1] - window + 1),
+                      dtype=bool)
+    for values, threshold in ((cons_values, conservation_threshold),
+                              (hydro_values, hydrophobicity_threshold)):
+        means = windowMeans(values, lengths, window)
+        if threshold is None:
+            passing &= ~np.isnan(means)
+        else:
+            with np.errstate(invalid='ignore'):
+                passing &= means >= threshold
+
+    # Mark the sites covered by a passing window, by counting the passing
+    # windows that start in the window before each site with prefix sums
+    filled = window + passing.shape[1]
+    started = np.zeros((len(names), cons_values.shape[1] + window))
+    np.cumsum(passing, axis=1, out=started[:, window:filled])
+    started[:, filled:] = started[:, [filled - 1]]
+    covered = started[:, window:] > started[:, :-window]
+
+    # Merge runs of covered sites into segments
+    edges = np.diff(np.pad(covered.astype(np.int8), ((0, 0), (1, 1))),
+                    axis=1)
+    rows, starts = np.nonzero(edges == 1)
+    _, ends = np.nonzero(edges == -1)
+
+    cons_sums, cons_counts = prefixSums(cons_values)
+    hydro_sums, hydro_counts = prefixSums(hydro_values)
+    return pd.DataFrame({
+        'reference': np.asarray(names, dtype=object)[rows],
+        'start': starts + 1,
+        'end': ends,
+        'length': ends - starts,
+        'conservation': rangeMeans(cons_sums, cons_counts, rows, starts,
+                                   ends),
+        'hydrophobicity': rangeMeans(hydro_sums, hydro_counts, rows, starts,
+                                     ends)
+    }, columns=SEGMENT_COLUMNS)
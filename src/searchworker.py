@@ -0,0 +1,374 @@
+"""
+A long-running local search worker that keeps the target database of the
+HMM searches resident, so repeated searches from one or more pipelines do
+not read, decompress and parse the database every time. The hmmer backend
+runs HMMER's search pipeline through pyhmmer on a database that is parsed
+into memory once, as HMMER's hmmpgmd daemon does.
+Written by: David Straat
+"""
+
+import io
+import os
+import threading
+from multiprocessing import Pipe, Process
+from multiprocessing.connection import Client, Listener
+
+import pyhmmer
+from Bio import SeqIO
+from pyhmmer.easel import Alphabet, SequenceFile
+from pyhmmer.plan7 import HMMFile
+
+from compression import openBinary, openText
+
+TBLOUT_HEADER = (
+    '#                                                               '
+    '--- full sequence ---- --- best 1 domain ---- --- domain number '
+    'estimation ----\n'
+    '# target name        accession  query name           accession  '
+    '  E-value  score  bias   E-value  score  bias   exp reg clu  ov env '
+    'dom rep inc description of target\n'
+    '#------------------- ---------- -------------------- ---------- '
+    '--------- ------ ----- --------- ------ -----   --- --- --- --- --- '
+    '--- --- --- ---------------------\n')
+# hmmsearch options and the matching keywords of a pyhmmer search
+HMMSEARCH_OPTIONS = {
+    '-E': 'E', '-T': 'T', '-Z': 'Z', '--domE': 'domE', '--domT': 'domT',
+    '--domZ': 'domZ', '--incE': 'incE', '--incT': 'incT',
+    '--incdomE': 'incdomE', '--incdomT': 'incdomT', '--F1': 'F1',
+    '--F2': 'F2', '--F3': 'F3', '--seed': 'seed'}
+HMMSEARCH_FLAGS = {
+    '--nobias': ('bias_filter', False), '--nonull2': ('null2', False),
+    '--cut_ga': ('bit_cutoffs', 'gathering'),
+    '--cut_tc': ('bit_cutoffs', 'trusted'),
+    '--cut_nc': ('bit_cutoffs', 'noise')}
+
+
+def searchOptions(options):
+    """
+    Convert hmmsearch options to the keywords of a pyhmmer search.
+    :param options: A list of hmmsearch command line options.
+    :return: A dict of keywords for pyhmmer.hmmsearch.
+    """
+    keywords = {}
+    options = list(options)
+    while options:
+        option = options.pop(0)
+        if option in HMMSEARCH_FLAGS:
+            keyword, value = HMMSEARCH_FLAGS[option]
+        elif option in HMMSEARCH_OPTIONS and options:
+            keyword = HMMSEARCH_OPTIONS[option]
+            value = options.pop(0)
+            value = int(value) if keyword == 'seed' else float(value)
+        else:
+            raise ValueError(f'The hmmsearch option {option} is not '
+                             f'supported by the search worker.')
+        keywords[keyword] = value
+    return keywords
+
+
+class HmmerBackend:
+    """
+    Searches with HMMER's search pipeline through pyhmmer. The database is
+    parsed and digitized into memory once, taking about a byte per residue
+    like the cache of hmmpgmd, so searches neither read nor parse it again.
+    Every search is spread over the targets on all threads.
+    """
+
+    def __init__(self, database, threads=None):
+        """
+        Loads the database.
+        :param database: The path of the (optionally compressed) fasta
+        database.
+        :param threads: The number of threads of every search. Defaults to
+        None, meaning the number of CPUs.
+        """
+        self.database = database
+        self.threads = threads or os.cpu_count()
+        with openBinary(database) as handle, \
+                SequenceFile(handle, format='fasta', digital=True,
+                             alphabet=Alphabet.amino()) as sequences:
+            self.targets = sequences.read_block()
+
+    def search(self, hmm, options=()):
+        """
+        Searches the database with a HMM.
+        :param hmm: The text of the HMM file.
+        :param options: Extra hmmsearch command line options, see
+        HMMSEARCH_OPTIONS and HMMSEARCH_FLAGS.
+        :return: The hits in hmmsearch's tblout format.
+        """
+        keywords = searchOptions(options)
+        with HMMFile(io.BytesIO(hmm.encode())) as handle:
+            query = handle.read()
+        hits = next(pyhmmer.hmmsearch(query, self.targets, cpus=self.threads,
+                                      parallel='targets', **keywords))
+        output = io.BytesIO()
+        hits.write(output, format='targets')
+        return output.getvalue().decode()
+
+
+class MemoryBackend:
+    """
+    A pure Python stand-in for hmmsearch, to test the worker without HMMER
+    installed. Targets are scored by the number of k-mers they share with
+    the consensus sequence of the HMM, so the hits are not those of a real
+    HMM search.
+    """
+
+    def __init__(self, database, k=3):
+        """
+        Loads the database.
+        :param database: The path of the (optionally compressed) fasta
+        database.
+        :param k: The length of the k-mers to compare.
+        """
+        self.database = database
+        self.k = k
+        with openText(database) as handle:
+            self.targets = [(record.id, record.description,
+                             self.kmers(str(record.seq)))
+                            for record in SeqIO.parse(handle, 'fasta')]
+
+    def kmers(self, sequence):
+        """
+        Get the distinct k-mers of a sequence.
+        :param sequence: The sequence.
+        :return: A set of k-mers.
+        """
+        sequence = sequence.upper().replace('-', '')
+        return {sequence[i:i + self.k]
+                for i in range(len(sequence) - self.k + 1)}
+
+    def search(self, hmm, options=()):
+        """
+        Scores every target against the consensus sequence of a HMM.
+        :param hmm: The text of the HMM file.
+        :param options: Ignored, accepted for compatibility with
+        HmmerBackend.
+        :return: The hits in hmmsearch's tblout format.
+        """
+        name, consensus = hmmConsensus(hmm)
+        query = self.kmers(consensus)
+        hits = sorted(((len(query & kmers), target, description)
+                       for target, description, kmers in self.targets),
+                      key=lambda hit: -hit[0])
+        lines = [TBLOUT_HEADER]
+        for score, target, description in hits:
+            if score == 0:
+                break
+            evalue = len(self.targets) * 2.0 ** -score
+            description = description.partition(' ')[2] or '-'
+            lines.append(f'{target:<20} {"-":<10} {name:<20} {"-":<10} '
+                         f'{evalue:9.2g} {score:6.1f} {0:5.1f} '
+                         f'{evalue:9.2g} {score:6.1f} {0:5.1f} '
+                         f'{1:5.1f} {1:3d} {0:3d} {0:3d} {1:3d} {1:3d} '
+                         f'{1:3d} {1:3d} {description}\n')
+        return ''.join(lines)
+
+
+def hmmConsensus(hmm):
+    """
+    Get the name and the consensus sequence of a HMMER3 file, i.e. the most
+    likely residue of each match state.
+    :param hmm: The text of the HMM file.
+    :return: A tuple of the name and the consensus sequence.
+    """
+    name, alphabet, consensus = '-', None, []
+    lines = iter(hmm.splitlines())
+    for line in lines:
+        tokens = line.split()
+        if not tokens:
+            continue
+        if tokens[0] == 'NAME':
+            name = tokens[1]
+        elif tokens[0] == 'HMM':
+            alphabet = tokens[1:]
+            next(lines)  # Transition labels
+        elif alphabet is not None and tokens[0] == 'COMPO':
+            next(lines)
+            next(lines)
+        elif alphabet is not None and tokens[0].isdigit():
+            emissions = [float(value) for value in
+                         tokens[1:len(alphabet) + 1]]
+            # Emissions are negative natural log probabilities
+            consensus.append(alphabet[emissions.index(min(emissions))])
+            next(lines)
+            next(lines)
+        elif tokens[0] == '//':
+            break
+    return name, ''.join(consensus)
+
+
+BACKENDS = {'hmmer': HmmerBackend, 'memory': MemoryBackend}
+
+
+def _handleConnection(connection, backend, stop):
+    """
+    Answers the requests of one client until it disconnects.
+    :param connection: The connection to the client.
+    :param backend: The backend to search with.
+    :param stop: A function that stops the worker, called on a shutdown
+    request.
+    """
+    with connection:
+        while True:
+            try:
+                request = connection.recv()
+            except EOFError:
+                return
+            if request[0] == 'shutdown':
+                connection.send(('ok', None))
+                stop()
+                return
+            try:
+                _, hmm, options = request
+                connection.send(('ok', backend.search(hmm, options)))
+            except Exception as error:
+                connection.send(('error', f'{type(error).__name__}: '
+                                          f'{error}'))
+
+
+def serve(database, backend, address, authkey, ready):
+    """
+    Loads the database and answers search requests until a shutdown
+    request. Every client is handled on its own thread.
+    :param database: The path of the database.
+    :param backend: The name of the backend, a key of BACKENDS.
+    :param address: The (host, port) address to listen on.
+    :param authkey: The key clients must authenticate with.
+    :param ready: A connection to send the listening address on, or the
+    error raised while loading the database.
+    """
+    try:
+        searcher = BACKENDS[backend](database)
+        listener = Listener(address, authkey=authkey)
+    except Exception as error:
+        ready.send(error)
+        return
+    stopping = threading.Event()
+
+    def stop():
+        # Wake up the accept call below with a connection of our own
+        stopping.set()
+        Client(listener.address, authkey=authkey).close()
+
+    ready.send(listener.address)
+    with listener:
+        while True:
+            connection = listener.accept()
+            if stopping.is_set():
+                connection.close()
+                return
+            threading.Thread(target=_handleConnection,
+                             args=(connection, searcher, stop),
+                             daemon=True).start()
+
+
+class SearchClient:
+    """
+    A client of a search worker, to be used instead of running hmmsearch.
+    """
+
+    def __init__(self, address, authkey):
+        """
+        Initiates the client.
+        :param address: The (host, port) address of the worker.
+        :param authkey: The key to authenticate with.
+        """
+        self.address = tuple(address)
+        self.authkey = authkey
+
+    def search(self, hmm_file, tblout_file, options=()):
+        """
+        Searches the database of the worker with a HMM.
+        :param hmm_file: The path of the HMM file.
+        :param tblout_file: The path to write the hits to, in hmmsearch's
+        tblout format.
+        :param options: Extra hmmsearch command line options, see
+        HMMSEARCH_OPTIONS and HMMSEARCH_FLAGS.
+        """
+        with open(hmm_file) as handle:
+            hmm = handle.read()
+        with Client(self.address, authkey=self.authkey) as connection:
+            connection.send(('search', hmm, list(options)))
+            status, result = connection.recv()
+        if status != 'ok':
+            raise RuntimeError(f'The search worker failed: {result}')
+        with open(tblout_file, 'w') as handle:
+            handle.write(result)
+
+    def shutdown(self):
+        """
+        Stops the worker.
+        """
+        with Client(self.address, authkey=self.authkey) as connection:
+            connection.send(('shutdown',))
+            connection.recv()
+
+
+class SearchWorker:
+    """
+    A search worker in a background process that loads the target database
+    once and answers HMM searches from any number of pipelines.
+    """
+
+    def __init__(self, database, backend='hmmer', address=('localhost', 0),
+                 authkey=None):
+        """
+        Initiates the worker.
+        :param database: The path of the (optionally compressed) database.
+        :param backend: 'hmmer' to search with HMMER's pipeline through
+        pyhmmer, or 'memory' for the pure Python stand-in. Defaults to
+        'hmmer'.
+        :param address: The (host, port) address to listen on. Defaults to
+        a free port on localhost.
+        :param authkey: The key clients must authenticate with. Defaults to
+        a random key.
+        """
+        if backend not in BACKENDS:
+            raise ValueError(f'Unknown backend {backend}, choose one of '
+                             f'{list(BACKENDS)}.')
+        self.database = database
+        self.backend = backend
+        self.address = address
+        self.authkey = authkey or os.urandom(16)
+        self.process = None
+
+    def start(self):
+        """
+        Starts the worker and waits until the database is loaded.
+        :return: The worker.
+        """
+        receiver, sender = Pipe(duplex=False)
+        self.process = Process(target=serve, daemon=True,
+                               args=(self.database, self.backend,
+                                     self.address, self.authkey, sender))
+        self.process.start()
+        result = receiver.recv()
+        if isinstance(result, Exception):
+            self.process.join()
+            raise result
+        self.address = result
+        return self
+
+    def client(self):
+        """
+        Get a client of the worker.
+        :return: A SearchClient.
+        """
+        return SearchClient(self.address, self.authkey)
+
+    def stop(self):
+        """
+        Stops the worker.
+        """
+        if self.process is not None and self.process.is_alive():
+            self.client().shutdown()
+            self.process.join()
+        self.process = None
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()